@@ -9,8 +9,6 @@ from scipy.spatial.transform import Rotation as scipy_R
 
 from rfdiffusion.util import rigid_from_3_points
 
-from rfdiffusion.util_module import ComputeAllAtomCoords
-
 from rfdiffusion import igso3
 import time
 
@@ -630,7 +628,6 @@ class Diffuser:
         if diffusion_mask is None:
             diffusion_mask = torch.zeros(len(xyz.squeeze())).to(dtype=bool)
 
-        get_allatom = ComputeAllAtomCoords().to(device=xyz.device)
         L = len(xyz)
 
         # bring to origin and scale
@@ -24,6 +24,8 @@ TOR_INDICES  = util.torsion_indices
 TOR_CAN_FLIP = util.torsion_can_flip
 REF_ANGLES   = util.reference_angles
 
+AUTOCAST_DTYPES = {'none': None, 'fp16': torch.float16, 'bf16': torch.bfloat16}
+
 
 class Sampler:
 
@@ -116,6 +118,10 @@ class Sampler:
         self.diffuser_conf = self._conf.diffuser
         self.preprocess_conf = self._conf.preprocess
 
+        if self.inf_conf.autocast_dtype not in AUTOCAST_DTYPES:
+            raise ValueError(f"Unrecognized autocast_dtype {self.inf_conf.autocast_dtype}, expected one of {list(AUTOCAST_DTYPES)}")
+        self.autocast_dtype = AUTOCAST_DTYPES[self.inf_conf.autocast_dtype]
+
         if conf.inference.schedule_directory_path is not None:
             schedule_directory = conf.inference.schedule_directory_path
         else:
@@ -169,6 +175,10 @@ class Sampler:
         '''
         return self.diffuser_conf.T
 
+    def autocast(self):
+        """Mixed precision context for the model forward pass, a no-op unless inference.autocast_dtype is set."""
+        return torch.autocast(self.device.type, dtype=self.autocast_dtype, enabled=self.autocast_dtype is not None)
+
     def load_checkpoint(self) -> None:
         """Loads RF checkpoint, from which config can be generated."""
         self._log.info(f'Reading checkpoint from {self.ckpt_path}')
@@ -258,11 +268,7 @@ class Sampler:
             seq_t: Starting sequence with a portion of them set to unknown.
         """
         
-        #######################
-        ### Parse input pdb ###
-        #######################
-
-        self.target_feats = iu.process_target(self.inf_conf.input_pdb, parse_hetatom=True, center=False)
+        # The input pdb is parsed once in initialize(), self.target_feats is only read from here on
 
         ################################
         ### Generate specific contig ###
@@ -566,22 +572,25 @@ class Sampler:
         pair_prev = None
         state_prev = None
 
-        with torch.no_grad():
-            msa_prev, pair_prev, px0, state_prev, alpha, logits, plddt = self.model(msa_masked,
-                                msa_full,
-                                seq_in,
-                                xt_in,
-                                idx_pdb,
-                                t1d=t1d,
-                                t2d=t2d,
-                                xyz_t=xyz_t,
-                                alpha_t=alpha_t,
-                                msa_prev = msa_prev,
-                                pair_prev = pair_prev,
-                                state_prev = state_prev,
-                                t=torch.tensor(t),
-                                return_infer=True,
-                                motif_mask=self.diffusion_mask.squeeze().to(self.device))
+        with torch.inference_mode():
+            with self.autocast():
+                msa_prev, pair_prev, px0, state_prev, alpha, logits, plddt = self.model(msa_masked,
+                                    msa_full,
+                                    seq_in,
+                                    xt_in,
+                                    idx_pdb,
+                                    t1d=t1d,
+                                    t2d=t2d,
+                                    xyz_t=xyz_t,
+                                    alpha_t=alpha_t,
+                                    msa_prev = msa_prev,
+                                    pair_prev = pair_prev,
+                                    state_prev = state_prev,
+                                    t=torch.tensor(t),
+                                    return_infer=True,
+                                    motif_mask=self.diffusion_mask.squeeze().to(self.device))
+            # Back to full precision for the all-atom frames and the denoiser
+            px0, alpha, plddt = px0.float(), alpha.float(), plddt.float()
 
         # prediction of X0 
         _, px0  = self.allatom(torch.argmax(seq_in, dim=-1), px0, alpha)
@@ -656,22 +665,25 @@ class SelfConditioning(Sampler):
         ### Forward Pass ###
         ####################
 
-        with torch.no_grad():
-            msa_prev, pair_prev, px0, state_prev, alpha, logits, plddt = self.model(msa_masked,
-                                msa_full,
-                                seq_in,
-                                xt_in,
-                                idx_pdb,
-                                t1d=t1d,
-                                t2d=t2d,
-                                xyz_t=xyz_t,
-                                alpha_t=alpha_t,
-                                msa_prev = None,
-                                pair_prev = None,
-                                state_prev = None,
-                                t=torch.tensor(t),
-                                return_infer=True,
-                                motif_mask=self.diffusion_mask.squeeze().to(self.device))   
+        with torch.inference_mode():
+            with self.autocast():
+                msa_prev, pair_prev, px0, state_prev, alpha, logits, plddt = self.model(msa_masked,
+                                    msa_full,
+                                    seq_in,
+                                    xt_in,
+                                    idx_pdb,
+                                    t1d=t1d,
+                                    t2d=t2d,
+                                    xyz_t=xyz_t,
+                                    alpha_t=alpha_t,
+                                    msa_prev = None,
+                                    pair_prev = None,
+                                    state_prev = None,
+                                    t=torch.tensor(t),
+                                    return_infer=True,
+                                    motif_mask=self.diffusion_mask.squeeze().to(self.device))   
+            # Back to full precision for the all-atom frames and the denoiser
+            px0, alpha, plddt = px0.float(), alpha.float(), plddt.float()
 
             if self.symmetry is not None and self.inf_conf.symmetric_self_cond:
                 px0 = self.symmetrise_prev_pred(px0=px0,seq_in=seq_in, alpha=alpha)[:,:,:3]
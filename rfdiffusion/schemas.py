@@ -42,6 +42,9 @@ class InferenceConfig(dict[str, Any]):
     schedule_directory_path: None | str
     model_directory_path: None | str
     device_name: str
+    compile_model: bool
+    compile_mode: Literal["default", "reduce-overhead", "max-autotune"]
+    autocast_dtype: Literal["none", "fp16", "bf16"]
 
 
 class ContigMapConfig(dict[str, Any]):
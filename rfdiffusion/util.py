@@ -672,29 +672,36 @@ def writepdb_multi(
     pdb file.
     """
 
-    f = open(filename, "w")
-
     if seq_stack.ndim != 2:
         T = atoms_stack.shape[0]
         seq_stack = torch.tile(seq_stack, (T, 1))
-    seq_stack = seq_stack.cpu()
-    for atoms, scpu in zip(atoms_stack, seq_stack):
+
+    # Move everything to plain python/numpy once up front: indexing tensors
+    # atom by atom dominates the write time for long trajectories.
+    atoms_stack = atoms_stack.detach().cpu().numpy()
+    missing_stack = np.isnan(atoms_stack).all(axis=-1).tolist()
+    atoms_stack = atoms_stack.tolist()
+    seq_stack = seq_stack.cpu().tolist()
+    Bfacts = torch.clamp(bfacts.cpu(), 0, 1).tolist()
+
+    n_atoms = None
+    if backbone_only:
+        n_atoms = N_BACKBONE_ATOMS
+    elif not use_hydrogens:
+        n_atoms = N_HEAVY
+
+    lines = []
+    for atoms, missing, scpu in zip(atoms_stack, missing_stack, seq_stack):
         ctr = 1
-        atomscpu = atoms.cpu()
-        Bfacts = torch.clamp(bfacts.cpu(), 0, 1)
         for i, s in enumerate(scpu):
-            atms = aa2long[s]
-            for j, atm_j in enumerate(atms):
-                if backbone_only and j >= N_BACKBONE_ATOMS:
-                    break
-                if not use_hydrogens and j >= N_HEAVY:
-                    break
-                if (atm_j is None) or (torch.all(torch.isnan(atomscpu[i, j]))):
+            chain_id = "A"
+            if chain_ids is not None:
+                chain_id = chain_ids[i]
+            for j, atm_j in enumerate(aa2long[s][:n_atoms]):
+                if (atm_j is None) or missing[i][j]:
                     continue
-                chain_id = "A"
-                if chain_ids is not None:
-                    chain_id = chain_ids[i]
-                f.write(
+                x, y, z = atoms[i][j]
+                lines.append(
                     "%-6s%5s %4s %3s %s%4d    %8.3f%8.3f%8.3f%6.2f%6.2f\n"
                     % (
                         "ATOM",
@@ -703,16 +710,19 @@ def writepdb_multi(
                         num2aa[s],
                         chain_id,
                         i + 1,
-                        atomscpu[i, j, 0],
-                        atomscpu[i, j, 1],
-                        atomscpu[i, j, 2],
+                        x,
+                        y,
+                        z,
                         1.0,
                         Bfacts[i],
                     )
                 )
                 ctr += 1
 
-        f.write("ENDMDL\n")
+        lines.append("ENDMDL\n")
+
+    with open(filename, "w") as f:
+        f.writelines(lines)
 
 def calc_rmsd(xyz1, xyz2, eps=1e-6):
     """
@@ -16,8 +16,11 @@ See https://hydra.cc/docs/advanced/hydra-command-line-flags/ for more options.
 """
 
 import re
+import functools
 import os, time, pickle
+from concurrent.futures import ThreadPoolExecutor
 import torch
+import torch.distributed as dist
 from omegaconf import OmegaConf
 import hydra
 import logging
@@ -26,53 +29,131 @@ from rfdiffusion.inference import utils as iu
 from rfdiffusion.schemas import RFDiffusionConfig
 import numpy as np
 import random
-import glob
 from typing import Optional
 
 log = logging.getLogger(__name__)
 
+DESIGN_NUM_RE = re.compile(r"_(\d+)\.pdb$")
+CUDA_ARCH_RE = re.compile(r"(sm|compute)_(\d+)")
+
 
 def make_deterministic(seed=0):
+    """
+    Reseed the global RNGs, called once per design with seed + design index.
+
+    All three are needed: contig lengths and scaffolds are drawn with random,
+    IGSO3 rotations and noise with numpy, CA noise with torch. Reseeding costs
+    far less than a single timestep.
+    """
     log.info(f"Setting random seed generator to {seed}")
     torch.manual_seed(seed)
     np.random.seed(seed)
     random.seed(seed)
 
 
+@functools.lru_cache(maxsize=1)
+def get_cuda_device():
+    """Return the first CUDA device this torch build has kernels for, or "cpu" if there is none."""
+    if not torch.cuda.is_available():
+        return "cpu"
+    log.debug("Cuda device found")
+
+    # Cubins (sm_XY) run on devices of the same major version with a minor
+    # version >= Y, PTX (compute_XY) can be JIT-compiled for any device >= XY
+    sm_archs, ptx_archs = [], []
+    for arch in torch.cuda.get_arch_list():
+        m = CUDA_ARCH_RE.match(arch)
+        if m:
+            (sm_archs if m.group(1) == "sm" else ptx_archs).append(int(m.group(2)))
+
+    for dev in range(torch.cuda.device_count()):
+        a, b = torch.cuda.get_device_capability(dev)
+        cur_arch = 10*a+b
+        if not sm_archs and not ptx_archs:
+            # No CUDA archs listed (e.g. ROCm builds), nothing to check against
+            return dev
+        if any(arch // 10 == a and arch <= cur_arch for arch in sm_archs) or any(arch <= cur_arch for arch in ptx_archs):
+            return dev
+        log.debug(f"Skipping cuda:{dev} (sm_{cur_arch}), not supported by this torch build")
+
+    return "cpu"
+
+
 def get_device_name(conf: Optional[RFDiffusionConfig] = None):
     name = "auto"
     if conf is not None:
         name = conf.inference.device_name
 
     if name == "auto":
-        name = "cpu"
-        if torch.cuda.is_available():
-            log.debug("Cuda device found")
-            # CUDA device may be available, but too old
-            min_arch = min(
-                (int(arch.split("_")[1]) for arch in torch.cuda.get_arch_list()),
-                default=35,
-            )
-            for dev in range(torch.cuda.device_count()):
-                a, b = torch.cuda.get_device_capability(dev)
-                cur_arch = 10*a+b
-                if cur_arch >= min_arch:
-                    name = dev
-                    break
+        name = get_cuda_device()
 
     return name
 
 
+def get_next_design_num(output_prefix: str) -> int:
+    """Return the index after the highest existing {output_prefix}_{i}.pdb, or 0 if there is none."""
+    output_dir, output_name = os.path.split(output_prefix)
+    output_dir = output_dir or "."
+    if not os.path.isdir(output_dir):
+        return 0
+    with os.scandir(output_dir) as entries:
+        return 1 + max(
+            (
+                int(m.group(1))
+                for entry in entries
+                if entry.name.startswith(output_name) and (m := DESIGN_NUM_RE.search(entry.name))
+            ),
+            default=-1,
+        )
+
+
+def write_trb(filename, trb):
+    with open(filename, "wb") as f_out:
+        pickle.dump(trb, f_out, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def compile_model(sampler) -> None:
+    """Wrap the sampler's denoising network with torch.compile."""
+    mode = sampler.inf_conf.compile_mode
+    if not hasattr(torch, "compile"):
+        log.warning("torch.compile requires PyTorch >= 2.0, running the model eagerly")
+        return
+    if sampler.device.type != "cuda":
+        log.warning("torch.compile is only enabled on CUDA devices, running the model eagerly")
+        return
+
+    # Shapes are static within a trajectory, so each new contig length is
+    # compiled (and graph-captured) once and replayed on every timestep.
+    # torch.jit.trace is not a cheaper alternative here: the SE(3) track builds
+    # a DGL graph from the current coordinates at every step, which a trace
+    # would silently freeze to the graph of the example inputs.
+    log.info(f"Compiling model with mode={mode!r}, the first design will include compilation time")
+    sampler.model = torch.compile(sampler.model, mode=mode, fullgraph=False, dynamic=False)
+
+
 @hydra.main(version_base=None, config_path="../config/inference", config_name="base")
 def main(conf: RFDiffusionConfig) -> None:
     logging.basicConfig(level=conf.logging.level)
 
+    # When launched with torchrun, each process samples its own share of the designs
+    rank = int(os.environ.get("RANK", 0))
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    if world_size > 1:
+        # Only used to synchronise the ranks, designs are written without any communication
+        dist.init_process_group("gloo")
+        log.info(f"Running as rank {rank} of {world_size}")
+
     if conf.inference.deterministic:
         make_deterministic(conf.inference.seed)
 
     # Check for available GPU and print result of check
     if conf.inference.device_name == "auto":
-        device_name = get_device_name(conf)
+        if world_size > 1 and torch.cuda.is_available():
+            # One GPU per process on each node
+            device_name = int(os.environ.get("LOCAL_RANK", 0))
+            torch.cuda.set_device(device_name)
+        else:
+            device_name = get_device_name(conf)
         if device_name == "cpu":
             log.info("////////////////////////////////////////////////")
             log.info("///// NO GPU DETECTED! Falling back to CPU /////")
@@ -85,113 +166,149 @@ def main(conf: RFDiffusionConfig) -> None:
         device_name = conf.inference.device_name
         log.info(f"Will run RFdiffusion on {device_name!r}")
 
+    if not conf.inference.deterministic:
+        # Allow TF32 tensor cores for float32 matmuls (Ampere and newer), kept
+        # off in deterministic mode so outputs still match the reference ones
+        torch.backends.cuda.matmul.allow_tf32 = True
+
     # Initialize sampler and target/contig.
+    # Rank 0 goes first so that the other ranks load its cached schedules
+    if world_size > 1 and rank != 0:
+        dist.barrier()
     sampler = iu.sampler_selector(conf)
+    if world_size > 1 and rank == 0:
+        dist.barrier()
+    if conf.inference.compile_model:
+        compile_model(sampler)
 
     # Loop over number of designs to sample.
     design_startnum = sampler.inf_conf.design_startnum
     if sampler.inf_conf.design_startnum == -1:
-        existing = glob.glob(sampler.inf_conf.output_prefix + "*.pdb")
-        indices = [-1]
-        for e in existing:
-            print(e)
-            m = re.match(r".*_(\d+)\.pdb$", e)
-            print(m)
-            if not m:
-                continue
-            m = m.groups()[0]
-            indices.append(int(m))
-        design_startnum = max(indices) + 1
-
-    for i_des in range(design_startnum, design_startnum + sampler.inf_conf.num_designs):
+        design_startnum = get_next_design_num(sampler.inf_conf.output_prefix)
+    design_nums = range(design_startnum, design_startnum + sampler.inf_conf.num_designs)
+
+    if sampler.inf_conf.cautious:
+        # Drop existing designs up front, so that ranks share out only the remaining work
+        todo = []
+        for i_des in design_nums:
+            out_prefix = f"{sampler.inf_conf.output_prefix}_{i_des}"
+            if os.path.isfile(out_prefix + ".pdb"):
+                log.info(
+                    f"(cautious mode) Skipping this design because {out_prefix}.pdb already exists."
+                )
+            else:
+                todo.append(i_des)
+        design_nums = todo
+
+    if world_size > 1:
+        # Every rank must see the same existing outputs before any new one is written
+        dist.barrier()
+
+    # The config is fixed once the sampler is initialized, resolve it once for all .trb files
+    resolved_conf = OmegaConf.to_container(sampler._conf, resolve=True)
+
+    # Outputs are written by a background thread while the next design samples.
+    # Everything handed to it lives on the host and is not modified afterwards.
+    io_exec = ThreadPoolExecutor(max_workers=1)
+    io_futures = []
+
+    # Designs are sampled one at a time: the sampler keeps per-design state
+    # (contig map, denoiser, self-conditioning prediction), contig lengths can
+    # differ between designs and the model inputs are built with batch size 1.
+    # The design index also sets the seed, so sharding keeps runs reproducible.
+    for i_des in design_nums[rank::world_size]:
         if conf.inference.deterministic:
             make_deterministic(conf.inference.seed + i_des)
 
         start_time = time.time()
         out_prefix = f"{sampler.inf_conf.output_prefix}_{i_des}"
         log.info(f"Making design {out_prefix}")
-        if sampler.inf_conf.cautious and os.path.exists(out_prefix + ".pdb"):
-            log.info(
-                f"(cautious mode) Skipping this design because {out_prefix}.pdb already exists."
-            )
-            continue
 
-        x_init, seq_init = sampler.sample_init()
-        denoised_xyz_stack = []
-        px0_xyz_stack = []
-        seq_stack = []
-        plddt_stack = []
+        if hasattr(sampler, "blockadjacency"):
+            # The scaffold (and its deterministic seed) follows the design
+            # index, not how many designs this process has made so far
+            blockadjacency = sampler.blockadjacency
+            blockadjacency.num_completed = i_des - design_startnum
+            if blockadjacency.systematic:
+                blockadjacency.item_n = blockadjacency.num_completed % len(blockadjacency.scaffold_list)
 
-        x_t = torch.clone(x_init)
-        seq_t = torch.clone(seq_init)
+        x_init, seq_init = sampler.sample_init()
+        timesteps = range(int(sampler.t_step_input), sampler.inf_conf.final_step - 1, -1)
+
+        # Trajectories are only kept when written out, and are filled last step
+        # first for better visualization in pymol
+        keep_traj = sampler.inf_conf.write_trajectory
+        if keep_traj:
+            denoised_xyz_stack = torch.empty((len(timesteps), *x_init.shape), dtype=x_init.dtype, device=x_init.device)
+            px0_xyz_stack = torch.empty_like(denoised_xyz_stack)
+        # For logging -- don't flip. Kept in (pinned) host memory so each
+        # step's copy is queued asynchronously behind the forward pass
+        use_cuda = sampler.device.type == "cuda"
+        plddt_stack = torch.empty((len(timesteps), x_init.shape[0]), pin_memory=use_cuda)
+
+        # sample_init returns fresh tensors and sample_step never modifies
+        # seq_init, so no defensive copies are needed
+        x_t = x_init
+        seq_t = seq_init
         # Loop over number of reverse diffusion time steps.
-        for t in range(int(sampler.t_step_input), sampler.inf_conf.final_step - 1, -1):
+        for step, t in enumerate(timesteps):
             px0, x_t, seq_t, plddt = sampler.sample_step(
                 t=t, x_t=x_t, seq_init=seq_t, final_step=sampler.inf_conf.final_step
             )
-            px0_xyz_stack.append(px0)
-            denoised_xyz_stack.append(x_t)
-            seq_stack.append(seq_t)
-            plddt_stack.append(plddt[0])  # remove singleton leading dimension
-
-        # Flip order for better visualization in pymol
-        denoised_xyz_stack = torch.stack(denoised_xyz_stack)
-        denoised_xyz_stack = torch.flip(
-            denoised_xyz_stack,
-            [
-                0,
-            ],
-        )
-        px0_xyz_stack = torch.stack(px0_xyz_stack)
-        px0_xyz_stack = torch.flip(
-            px0_xyz_stack,
-            [
-                0,
-            ],
-        )
-
-        # For logging -- don't flip
-        plddt_stack = torch.stack(plddt_stack)
+            if keep_traj:
+                px0_xyz_stack[-1 - step].copy_(px0)
+                denoised_xyz_stack[-1 - step].copy_(x_t)
+            # remove singleton leading dimension, copying also takes it out of
+            # the model's output buffers that CUDA graph replays overwrite
+            plddt_stack[step].copy_(plddt[0], non_blocking=use_cuda)
+        if use_cuda:
+            torch.cuda.current_stream(sampler.device).synchronize()
+
+        # The previous design's outputs were written while this one sampled.
+        # Wait for them here, so that a failed write stops the run right away
+        # and at most one design's outputs are queued at a time.
+        for future in io_futures:
+            future.result()
+        io_futures = []
 
         # Save outputs
         os.makedirs(os.path.dirname(out_prefix), exist_ok=True)
-        final_seq = seq_stack[-1]
 
         # Output glycines, except for motif region
-        final_seq = torch.where(
-            torch.argmax(seq_init, dim=-1) == 21, 7, torch.argmax(seq_init, dim=-1)
-        )  # 7 is glycine
+        seq_init_argmax = torch.argmax(seq_init, dim=-1)
+        is_diffused = seq_init_argmax == 21  # 21 is the mask token
+        final_seq = torch.where(is_diffused, 7, seq_init_argmax)  # 7 is glycine
 
         bfacts = torch.ones_like(final_seq.squeeze())
         # make bfact=0 for diffused coordinates
-        bfacts[torch.where(torch.argmax(seq_init, dim=-1) == 21, True, False)] = 0
+        bfacts[is_diffused.squeeze()] = 0
         # pX0 last step
         out = f"{out_prefix}.pdb"
 
         # Now don't output sidechains
-        writepdb(
+        io_futures.append(io_exec.submit(
+            writepdb,
             out,
-            denoised_xyz_stack[0, :, :4],
+            x_t[:, :4],
             final_seq,
             sampler.binderlen,
             chain_idx=sampler.chain_idx,
             bfacts=bfacts,
-        )
+        ))
 
         # run metadata
         trb = dict(
-            config=OmegaConf.to_container(sampler._conf, resolve=True),
-            plddt=plddt_stack.cpu().numpy(),
+            config=resolved_conf,
+            plddt=plddt_stack.numpy(),
             device=device_name,
             time=time.time() - start_time,
         )
-        if hasattr(sampler, "contig_map"):
-            for key, value in sampler.contig_map.get_mappings().items():
-                trb[key] = value
-        with open(f"{out_prefix}.trb", "wb") as f_out:
-            pickle.dump(trb, f_out)
+        if hasattr(sampler, "mappings"):
+            # computed by sample_init for this design's contig
+            trb.update(sampler.mappings)
+        io_futures.append(io_exec.submit(write_trb, f"{out_prefix}.trb", trb))
 
-        if sampler.inf_conf.write_trajectory:
+        if keep_traj:
             # trajectory pdbs
             traj_prefix = (
                 os.path.dirname(out_prefix) + "/traj/" + os.path.basename(out_prefix)
@@ -199,7 +316,8 @@ def main(conf: RFDiffusionConfig) -> None:
             os.makedirs(os.path.dirname(traj_prefix), exist_ok=True)
 
             out = f"{traj_prefix}_Xt-1_traj.pdb"
-            writepdb_multi(
+            io_futures.append(io_exec.submit(
+                writepdb_multi,
                 out,
                 denoised_xyz_stack,
                 bfacts,
@@ -207,10 +325,11 @@ def main(conf: RFDiffusionConfig) -> None:
                 use_hydrogens=False,
                 backbone_only=False,
                 chain_ids=sampler.chain_idx,
-            )
+            ))
 
             out = f"{traj_prefix}_pX0_traj.pdb"
-            writepdb_multi(
+            io_futures.append(io_exec.submit(
+                writepdb_multi,
                 out,
                 px0_xyz_stack,
                 bfacts,
@@ -218,10 +337,18 @@ def main(conf: RFDiffusionConfig) -> None:
                 use_hydrogens=False,
                 backbone_only=False,
                 chain_ids=sampler.chain_idx,
-            )
+            ))
 
         log.info(f"Finished design in {(time.time()-start_time)/60:.2f} minutes")
 
+    # Wait for pending outputs, re-raising any error from the writer thread
+    for future in io_futures:
+        future.result()
+    io_exec.shutdown()
+
+    if world_size > 1:
+        dist.destroy_process_group()
+
 
 if __name__ == "__main__":
     main()